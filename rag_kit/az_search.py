@@ -1,4 +1,9 @@
 import re
+import string
+
+_VALID_BYTES = (string.ascii_lowercase + string.digits + "-_").encode("ascii")
+_INVALID_BYTES = bytes(b for b in range(128) if b not in _VALID_BYTES)
+_DUP_SEP = re.compile(rb"[-_]{2,}")
 
 
 def sanitize_azure_search_index_name(input_string: str) -> str:
@@ -11,19 +16,21 @@ def sanitize_azure_search_index_name(input_string: str) -> str:
     - First character must be a letter or number
     - No consecutive dashes or underscores
     """
-    input_string = input_string.lower()
-
-    valid_chars = re.sub(r"[^a-z0-9-_]", "", input_string)
+    # Every allowed character is ASCII, so drop the rest while encoding and
+    # delete the remaining invalid bytes in a single translate pass.
+    valid_chars = (
+        input_string.lower().encode("ascii", "ignore").translate(None, _INVALID_BYTES)
+    )
 
-    if not valid_chars[0].isalnum():
-        valid_chars = "d" + valid_chars
+    if not valid_chars[:1].isalnum():
+        valid_chars = b"d" + valid_chars
 
-    valid_chars = re.sub(r"[-_]{2,}", "-", valid_chars)
+    valid_chars = _DUP_SEP.sub(b"-", valid_chars)
 
     if len(valid_chars) > 128:
         valid_chars = valid_chars[:128]
 
     if len(valid_chars) < 2:
-        valid_chars = valid_chars + "a" * (2 - len(valid_chars))
+        valid_chars = valid_chars + b"a" * (2 - len(valid_chars))
 
-    return valid_chars
+    return valid_chars.decode("ascii")
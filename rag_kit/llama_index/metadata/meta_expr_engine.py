@@ -32,7 +32,8 @@ Example of a supported expression:
 """
 
 import ast
-from typing import List
+from functools import lru_cache
+from typing import Any, NamedTuple, Optional, Tuple, Union
 
 from llama_index.core.vector_stores import (
     FilterCondition,
@@ -41,31 +42,36 @@ from llama_index.core.vector_stores import (
     MetadataFilters,
 )
 
+_OPERATOR_MAP = {
+    ast.Eq: FilterOperator.EQ,
+    ast.NotEq: FilterOperator.NE,
+    ast.Lt: FilterOperator.LT,
+    ast.Gt: FilterOperator.GT,
+    ast.LtE: FilterOperator.LTE,
+    ast.GtE: FilterOperator.GTE,
+    ast.In: FilterOperator.IN,
+    ast.NotIn: FilterOperator.NIN,
+}
 
-class MetaExprVisitor(ast.NodeVisitor):
-    """AST visitor class to collect comparisons and conditions from an expression."""
+_CONDITION_MAP = {
+    ast.And: FilterCondition.AND,
+    ast.Or: FilterCondition.OR,
+}
 
-    def __init__(self):
-        self.comparisons = []
-        self.conditions = []
 
-    def visit_Compare(self, node):
-        """Visit a comparison node and extract details."""
-        comparison = {"key": None, "value": None, "operator": None}
-        if isinstance(node.left, ast.Name):
-            comparison["key"] = node.left.id
-        if isinstance(node.comparators[0], ast.Constant):
-            comparison["value"] = node.comparators[0].value
-        elif isinstance(node.comparators[0], ast.List):
-            comparison["value"] = [elt.value for elt in node.comparators[0].elts]
-        comparison["operator"] = node.ops[0]
-        self.comparisons.append(comparison)
-        self.generic_visit(node)
+class _CompareSpec(NamedTuple):
+    """Immutable description of a single MetadataFilter."""
 
-    def visit_BoolOp(self, node):
-        """Visit a boolean operation node and extract the condition."""
-        self.generic_visit(node)
-        self.conditions.append(type(node.op).__name__)
+    key: Optional[str]
+    value: Any
+    operator: FilterOperator
+
+
+class _BoolOpSpec(NamedTuple):
+    """Immutable description of a MetadataFilters group."""
+
+    condition: FilterCondition
+    children: Tuple[Union[_CompareSpec, "_BoolOpSpec"], ...]
 
 
 def parse_expression(expression: str) -> MetadataFilters:
@@ -74,76 +80,70 @@ def parse_expression(expression: str) -> MetadataFilters:
     if not expression:
         return MetadataFilters(filters=[])
 
-    tree = ast.parse(expression, mode="eval")
+    filters = _to_filters(_compile_expression(expression))
+    if isinstance(filters, MetadataFilter):
+        return MetadataFilters(filters=[filters])
+
+    return filters
 
-    visitor = MetaExprVisitor()
-    visitor.visit(tree)
 
-    return _build_metadata_filters(visitor.comparisons, visitor.conditions)
+@lru_cache(maxsize=1024)
+def _compile_expression(expression: str) -> Union[_CompareSpec, _BoolOpSpec]:
+    """
+    Parse an expression into an immutable filter spec, once per string. The
+    spec is shared between calls, so every call builds fresh filter models
+    from it that the caller is free to mutate.
+    """
 
+    tree = ast.parse(expression, mode="eval")
 
-def _build_metadata_filters(
-    comparisons: List[dict], conditions: List[str]
-) -> MetadataFilters:
-    """Build a MetadataFilters object from comparisons and conditions."""
+    return _build(tree.body)
 
-    if not comparisons:
-        return MetadataFilters(filters=[])
 
-    current_metadata_filters = MetadataFilters(filters=[])
-    last_condition = None
-    nested_filters = []
-
-    for i, comparison in enumerate(comparisons):
-        key = comparison["key"]
-        value = comparison["value"]
-        operator = _map_operator(comparison["operator"])
-
-        current_metadata_filters.filters.append(
-            MetadataFilter(
-                key=key,
-                value=value,
-                operator=operator,
-            )
+def _build(node: ast.expr) -> Union[_CompareSpec, _BoolOpSpec]:
+    """Recursively build a filter spec from a boolean operation or comparison."""
+
+    if isinstance(node, ast.BoolOp):
+        return _BoolOpSpec(
+            condition=_CONDITION_MAP[type(node.op)],
+            children=tuple(_build(value) for value in node.values),
+        )
+
+    if isinstance(node, ast.Compare):
+        key = node.left.id if isinstance(node.left, ast.Name) else None
+        comparator = node.comparators[0]
+        if isinstance(comparator, ast.Constant):
+            value = comparator.value
+        elif isinstance(comparator, ast.List):
+            # Stored as a tuple to keep the cached spec immutable.
+            value = tuple(elt.value for elt in comparator.elts)
+        else:
+            value = None
+        operator = _OPERATOR_MAP.get(type(node.ops[0]))
+        if operator is None:
+            raise ValueError(f"Unsupported operator: {type(node.ops[0]).__name__}")
+        return _CompareSpec(key=key, value=value, operator=operator)
+
+    raise ValueError(f"Unsupported expression: {type(node).__name__}")
+
+
+def _to_filters(
+    spec: Union[_CompareSpec, _BoolOpSpec],
+) -> Union[MetadataFilter, MetadataFilters]:
+    """Build new filter models from a cached filter spec."""
+
+    if isinstance(spec, _BoolOpSpec):
+        return MetadataFilters(
+            filters=[_to_filters(child) for child in spec.children],
+            condition=spec.condition,
         )
 
-        if i < len(conditions):
-            condition = _map_condition(conditions[i])
-            if last_condition and last_condition != condition:
-                nested_filters.append(current_metadata_filters)
-                current_metadata_filters = MetadataFilters(
-                    filters=[], condition=condition
-                )
-            else:
-                current_metadata_filters.condition = condition
-            last_condition = condition
-
-    if current_metadata_filters.filters:
-        nested_filters.append(current_metadata_filters)
-
-    if len(nested_filters) == 1:
-        return nested_filters[0]
-
-    return MetadataFilters(filters=nested_filters)
-
-
-def _map_operator(operator: type) -> FilterOperator:
-    """Map AST operator type to FilterOperator enum."""
-    operator_str = type(operator).__name__.upper()
-    if operator_str == "NOTEQ":
-        operator_str = "NE"
-    try:
-        return FilterOperator[operator_str]
-    except KeyError:
-        raise ValueError(f"Unsupported operator: {operator_str}")
-
-
-def _map_condition(condition: str) -> FilterCondition:
-    """Map AST condition string to FilterCondition enum."""
-    try:
-        return FilterCondition[condition.upper()]
-    except KeyError:
-        raise ValueError(f"Unsupported condition: {condition}")
+    value = spec.value
+    if isinstance(value, tuple):
+        value = list(value)
+    # Validated on every call rather than via construct(): the spec may hold a
+    # None key or value (e.g. "1 == a") that MetadataFilter must reject.
+    return MetadataFilter(key=spec.key, value=value, operator=spec.operator)
 
 
 if __name__ == "__main__":
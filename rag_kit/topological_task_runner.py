@@ -1,81 +1,129 @@
 """
 Module for executing asynchronous and synchronous tasks in a topological order
 based on their dependencies. It uses Python's asyncio for asynchronous tasks and
-a custom thread pool executor for synchronous tasks. The results of the tasks
-are stored in a nested dictionary structure based on keys specified via
-decorators.
+a custom thread pool executor for synchronous tasks, or a process pool for
+CPU-bound synchronous tasks. The results of the tasks are stored in a nested
+dictionary structure based on keys specified via decorators.
 Fran Aguilera
 06/07/24
 """
 
 import asyncio
+import contextvars
 import logging
-from concurrent.futures import Executor, ThreadPoolExecutor
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from graphlib import TopologicalSorter
-from time import sleep, time
+from operator import itemgetter
+from time import perf_counter_ns, sleep
 from types import TracebackType
-from typing import Any, Callable, Dict, List, Optional, Tuple
-
-from pydantic import BaseModel, Field, field_validator
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 
-class TPTask(BaseModel):
-    name: Optional[str] = Field(default=None)
+@dataclass(frozen=True, slots=True, kw_only=True)
+class TPTask:
+    name: Optional[str] = None
     func: Callable[..., Any]
-    deps: List[str] = Field(default_factory=list)
-    args: List[Any] = Field(default_factory=list)
-    kwargs: Dict[str, Any] = Field(default_factory=dict)
-    res_key: Optional[str] = Field(default=None)
-
-    @field_validator("func")
-    def validate_func(cls, v):
-        if not callable(v):
-            raise TypeError("func must be a callable")
-        return v
-
-    @field_validator("deps", mode="before")
-    def validate_deps(cls, v):
-        if not isinstance(v, list):
-            raise TypeError("deps must be a list")
-        if not all(isinstance(dep, str) for dep in v):
-            raise TypeError("Each dependency must be a string")
-        return v
-
-    @field_validator("args", mode="before")
-    def validate_args(cls, v):
-        if not isinstance(v, list):
-            raise TypeError("args must be a list")
-        return v
-
-    @field_validator("kwargs", mode="before")
-    def validate_kwargs(cls, v: Any):
-        if not isinstance(v, dict):
-            raise TypeError("kwargs must be a dict")
-        return v
-
-    @field_validator("res_key")
-    def validate_res_key(cls, v):
-        if v is not None and not isinstance(v, str):
-            raise TypeError("res_key must be a string or None")
-        return v
+    deps: List[str] = field(default_factory=list)
+    args: List[Any] = field(default_factory=list)
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    res_key: Optional[str] = None
+    # Where a synchronous func runs: "thread" for blocking IO on the runner's
+    # executor, "process" for CPU-bound work that would contend for the GIL, or
+    # "inline" for cheap calls made directly on the event loop thread.
+    executor_kind: Literal["thread", "process", "inline"] = "thread"
+    # Reuse the result of a previous call with equal, hashable arguments
+    # instead of executing func again, e.g. when re-running failed subgraphs.
+    pure: bool = False
+    # Run a thread-executed func in a copy of the caller's contextvars context,
+    # as asyncio.to_thread does. Off by default to skip the per-call copy.
+    propagate_context: bool = False
+
+
+class _TaskPlan(NamedTuple):
+    """Per-task dispatch data, resolved once per run from its TPTask."""
+
+    dispatch: Callable[..., Awaitable[Any]]
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+    dep_names: Tuple[str, ...]
+    dep_getter: Optional[Callable[[Dict[str, Any]], Tuple[Any, ...]]]
+    res_key_path: Optional[Tuple[str, ...]]
+
+
+class _TaskGraph(NamedTuple):
+    """Validated dependency structure of a set of tasks, shared across runs."""
+
+    dependents: Dict[str, Tuple[str, ...]]
+    remaining: Dict[str, int]
+    external_deps: Tuple[Tuple[str, str], ...]
+
+
+def _pool_size() -> int:
+    """
+    Size of the runner's default thread pool. RAG tasks are mostly blocking IO
+    (embedding, search and LLM calls), so default to more threads than
+    ThreadPoolExecutor's min(32, cpus + 4). Override with
+    RAG_KIT_THREAD_POOL_SIZE.
+    """
+    pool_size = os.environ.get("RAG_KIT_THREAD_POOL_SIZE")
+    if pool_size is not None:
+        return int(pool_size)
+    return min(32, (os.cpu_count() or 1) * 4)
 
 
 class TopologicalTaskRunner:
+    graph_cache_size: int = 32
+    pure_cache_size: int = 128
+
     def __init__(
         self,
         executor: Optional[Executor] = None,
         event_loop: Optional[asyncio.AbstractEventLoop] = None,
         logger: Optional[logging.Logger] = None,
+        release_consumed_results: bool = False,
     ):
+        """Create a TopologicalTaskRunner.
+        Args:
+            release_consumed_results (bool): Drop a task's result from
+                task_results once every dependent has completed successfully,
+                unless the task has a res_key. Keeps peak memory down for
+                pipelines passing large intermediate payloads.
+        """
+        self.release_consumed_results = release_consumed_results
+        # Outstanding consumers of results kept after a run because a consumer
+        # failed or was skipped, so a later retry can still release them.
+        self._held_results: Dict[str, set[str]] = {}
         self._failed_tasks: Dict[str, TPTask] = {}
         self.task_results: Dict[str, Any] = {}
         self.task_errors: Dict[str, BaseException] = {}
         self.logger = logger or logging.getLogger(__name__)
-        self.executor = executor if executor else ThreadPoolExecutor()
+        # Executors passed in by the caller may be shared, so only the one
+        # created here is shut down by reset().
+        self._owns_executor = executor is None
+        self.executor = executor if executor else ThreadPoolExecutor(_pool_size())
+        self._process_executor: Optional[ProcessPoolExecutor] = None
+        self._graph_cache: OrderedDict[
+            frozenset[Tuple[str, Tuple[str, ...]]], _TaskGraph
+        ] = OrderedDict()
+        self._pure_cache: OrderedDict[Tuple[Any, ...], Any] = OrderedDict()
         try:
             self.loop = event_loop if event_loop else asyncio.get_running_loop()
         except RuntimeError:
@@ -141,58 +189,145 @@ class TopologicalTaskRunner:
                 self._failed_tasks.pop(name, None)
                 self.task_errors.pop(name, None)
 
+    @property
+    def process_executor(self) -> ProcessPoolExecutor:
+        """The process pool for CPU-bound tasks, created on first use."""
+        if self._process_executor is None:
+            self._process_executor = ProcessPoolExecutor()
+        return self._process_executor
+
+    def _make_dispatch(self, task: TPTask) -> Callable[..., Awaitable[Any]]:
+        """
+        Resolve once how a task's func is awaited: coroutine functions are
+        awaited directly and synchronous funcs are run according to the task's
+        executor_kind.
+        """
+        func = task.func
+        if asyncio.iscoroutinefunction(func):
+            return func
+
+        if task.executor_kind == "inline":
+
+            async def run_inline(*args: Any, **kwargs: Any) -> Any:
+                return func(*args, **kwargs)
+
+            return run_inline
+
+        if task.executor_kind == "process":
+            if task.propagate_context:
+                raise ValueError("propagate_context is not supported for processes")
+            executor: Executor = self.process_executor
+        elif task.executor_kind == "thread":
+            executor = self.executor
+        else:
+            raise ValueError(f"Unsupported executor kind: {task.executor_kind}")
+
+        if task.propagate_context:
+
+            async def run_in_context(*args: Any, **kwargs: Any) -> Any:
+                context = contextvars.copy_context()
+                return await asyncio.get_running_loop().run_in_executor(
+                    executor, partial(context.run, func, *args, **kwargs)
+                )
+
+            return run_in_context
+
+        async def run_in_executor(*args: Any, **kwargs: Any) -> Any:
+            loop = asyncio.get_running_loop()
+            if kwargs:
+                return await loop.run_in_executor(
+                    executor, partial(func, *args, **kwargs)
+                )
+            return await loop.run_in_executor(executor, func, *args)
+
+        return run_in_executor
+
+    def _memoize(
+        self, func: Callable[..., Any], dispatch: Callable[..., Awaitable[Any]]
+    ) -> Callable[..., Awaitable[Any]]:
+        """
+        Wrap a pure task's dispatch in the runner's LRU result cache. Calls with
+        unhashable arguments are always executed.
+        """
+        cache = self._pure_cache
+
+        async def run_memoized(*args: Any, **kwargs: Any) -> Any:
+            try:
+                key = (func, args, frozenset(kwargs.items()))
+                if key in cache:
+                    cache.move_to_end(key)
+                    return cache[key]
+            except TypeError:
+                return await dispatch(*args, **kwargs)
+
+            result = await dispatch(*args, **kwargs)
+            cache[key] = result
+            if len(cache) > self.pure_cache_size:
+                cache.popitem(last=False)
+            return result
+
+        return run_memoized
+
     async def _execute_task(
-        self, name: str, func: Callable[..., Any], *args: Any, **kwargs: Any
+        self,
+        name: str,
+        dispatch: Callable[..., Awaitable[Any]],
+        *args: Any,
+        **kwargs: Any,
     ) -> Any:
+        logger = self.logger
         try:
-            start_time = time()
-            self.logger.info(f"Executing {name}")
-            result = await (
-                func(*args, **kwargs)
-                if asyncio.iscoroutinefunction(func)
-                else asyncio.to_thread(func, *args, **kwargs)
-            )
-            elapsed_time = time() - start_time
-            elapsed_time_ms = elapsed_time * 1000
-            self.logger.info(
-                f"Executed {name} in {elapsed_time:.2f}s ({elapsed_time_ms:.0f}ms)"
-            )
+            start_ns = perf_counter_ns()
+            logger.debug("Executing %s", name)
+            result = await dispatch(*args, **kwargs)
+            if logger.isEnabledFor(logging.INFO):
+                elapsed_ns = perf_counter_ns() - start_ns
+                logger.info(
+                    "Executed %s in %.2fs (%dms)",
+                    name,
+                    elapsed_ns / 1e9,
+                    elapsed_ns // 1_000_000,
+                )
         except BaseException as be:
-            self.logger.exception(
-                f"Error executing task {name}\n{be!s}", stack_info=True
-            )
+            logger.exception("Error executing task %s\n%s", name, be, stack_info=True)
+            raise
         return result
 
     def _calculate_ready_tasks(
-        self,
-        ready_names: tuple[str, ...],
-        task_func_map: Dict[str, Callable[..., Any]],
-        task_deps_map: Dict[str, List[str]],
-        task_map: Dict[str, TPTask],
-    ) -> List[asyncio.Future]:
-        ready_tasks: List[asyncio.Future] = []
+        self, ready_names: tuple[str, ...], plan: Dict[str, _TaskPlan]
+    ) -> List[asyncio.Task]:
+        ready_tasks: List[asyncio.Task] = []
+        task_results = self.task_results
+        loop = asyncio.get_running_loop()
 
         for name in ready_names:
-            func = task_func_map[name]
-            task_deps = task_deps_map.get(name)
-
-            dep_results = {dep: self.task_results[dep] for dep in task_deps}
-
-            args = task_map[name].args
-            kwargs = {**dep_results, **task_map[name].kwargs}
+            dispatch, args, static_kwargs, dep_names, dep_getter, _ = plan[name]
+
+            if dep_getter is not None:
+                kwargs = dict(zip(dep_names, dep_getter(task_results)))
+                kwargs.update(static_kwargs)
+            elif dep_names:
+                kwargs = {dep_names[0]: task_results[dep_names[0]]}
+                kwargs.update(static_kwargs)
+            else:
+                kwargs = static_kwargs
 
             ready_tasks.append(
-                asyncio.ensure_future(self._execute_task(name, func, *args, **kwargs))
+                loop.create_task(self._execute_task(name, dispatch, *args, **kwargs))
             )
 
         return ready_tasks
 
     def _map_tasks_functions_and_dependencies(
         self, tasks_to_run: List[TPTask]
-    ) -> Tuple[Dict[str, TPTask], Dict[str, Callable[..., Any]], Dict[str, List[str]]]:
+    ) -> Tuple[
+        Dict[str, TPTask],
+        Dict[str, _TaskPlan],
+        Dict[str, Tuple[str, ...]],
+        Dict[str, int],
+    ]:
         task_map: Dict[str, TPTask] = {}
-        task_func_map: Dict[str, Callable[..., Any]] = {}
-        task_deps_map: Dict[str, List[str]] = {}
+        plan: Dict[str, _TaskPlan] = {}
 
         for task in tasks_to_run:
             func = task.func
@@ -201,62 +336,200 @@ class TopologicalTaskRunner:
             if name in task_map:
                 raise ValueError(f"Duplicate task name detected: {name}")
 
+            dispatch = self._make_dispatch(task)
+            if task.pure:
+                dispatch = self._memoize(func, dispatch)
+
+            dep_names = tuple(task.deps)
             task_map[name] = task
-            task_func_map[name] = func
-            task_deps_map[name] = task.deps
+            plan[name] = _TaskPlan(
+                dispatch=dispatch,
+                args=tuple(task.args),
+                kwargs=dict(task.kwargs),
+                dep_names=dep_names,
+                dep_getter=itemgetter(*dep_names) if len(dep_names) > 1 else None,
+                res_key_path=tuple(task.res_key.split(".")) if task.res_key else None,
+            )
 
-        return task_map, task_func_map, task_deps_map
+        graph = self._get_task_graph(plan)
+        for name, dep in graph.external_deps:
+            if dep not in self.task_results:
+                raise ValueError(f"Unknown dependency {dep} for task {name}")
+
+        return task_map, plan, graph.dependents, dict(graph.remaining)
+
+    def _get_task_graph(self, plan: Dict[str, _TaskPlan]) -> _TaskGraph:
+        """
+        Return the validated task graph for the plan's names and dependencies,
+        reusing the one built for a previous run of the same graph.
+        """
+        key = frozenset((name, task_plan.dep_names) for name, task_plan in plan.items())
+        graph = self._graph_cache.get(key)
+        if graph is not None:
+            self._graph_cache.move_to_end(key)
+            return graph
+
+        # Reverse adjacency and in-degree counts for Kahn's algorithm.
+        # Dependencies outside of this run (e.g. when re-running failed tasks)
+        # are satisfied by results from a previous run.
+        dependents: Dict[str, List[str]] = {name: [] for name in plan}
+        remaining: Dict[str, int] = {}
+        external_deps: List[Tuple[str, str]] = []
+        for name, task_plan in plan.items():
+            count = 0
+            for dep in task_plan.dep_names:
+                if dep in plan:
+                    dependents[dep].append(name)
+                    count += 1
+                else:
+                    external_deps.append((name, dep))
+            remaining[name] = count
+
+        # Graphs are validated once and cached, so let graphlib find and report
+        # the exact cycle.
+        TopologicalSorter(
+            {name: task_plan.dep_names for name, task_plan in plan.items()}
+        ).prepare()
+
+        graph = _TaskGraph(
+            dependents={name: tuple(names) for name, names in dependents.items()},
+            remaining=remaining,
+            external_deps=tuple(external_deps),
+        )
+        self._graph_cache[key] = graph
+        if len(self._graph_cache) > self.graph_cache_size:
+            self._graph_cache.popitem(last=False)
+        return graph
 
-    def format_results(self, task_map: Dict[str, TPTask]) -> Dict[str, Any]:
+    def _release_consumed(
+        self,
+        name: str,
+        dep_names: Tuple[str, ...],
+        consumers: Dict[str, set[str]],
+    ) -> None:
+        """
+        Record that task name consumed its dependencies' results and drop each
+        result once it has no outstanding consumers, in this run or a previous
+        one.
+        """
+        for dep in dep_names:
+            outstanding = consumers.get(dep)
+            if outstanding is None:
+                outstanding = self._held_results.get(dep)
+                if outstanding is None:
+                    continue
+            outstanding.discard(name)
+            if not outstanding:
+                self.task_results.pop(dep, None)
+                self._held_results.pop(dep, None)
+
+    def format_results(self, plan: Dict[str, _TaskPlan]) -> Dict[str, Any]:
         """
         Extract the final results dict from the task results based on result keys.
         """
         formatted_results: Dict[str, Any] = {}
 
         for name, result in self.task_results.items():
-            task = task_map[name]
-            result_key = task.res_key
-            result_keys = result_key.split(".") if result_key else None
-            if result_keys is not None:
-                cur_results = formatted_results
-                for key in result_keys[:-1]:
-                    cur_results = cur_results.setdefault(key, {})
-                cur_results[result_keys[-1]] = result
+            task_plan = plan.get(name)
+            if task_plan is None or task_plan.res_key_path is None:
+                continue
+            *parent_keys, last_key = task_plan.res_key_path
+            cur_results = formatted_results
+            for key in parent_keys:
+                cur_results = cur_results.setdefault(key, {})
+            cur_results[last_key] = result
 
         return formatted_results
 
     async def arun(self, tasks_to_run: List[TPTask]) -> Dict[str, Any]:
         """Execute tasks in topological order and handle dependencies."""
-        start_time = time()
-        task_map, task_func_map, task_deps_map = (
+        start_ns = perf_counter_ns()
+        task_map, plan, dependents, remaining = (
             self._map_tasks_functions_and_dependencies(tasks_to_run)
         )
 
-        ts = TopologicalSorter(task_deps_map)
-        ts.prepare()
-
-        while ts.is_active():
-            ready_names = ts.get_ready()
+        # Each task is started as soon as its own dependencies are done, rather
+        # than waiting for the rest of its topological layer to finish.
+        ready = deque(name for name, count in remaining.items() if not count)
+        completion_queue: asyncio.Queue[str] = asyncio.Queue()
+        running: Dict[str, asyncio.Task] = {}
+        consumers: Optional[Dict[str, set[str]]] = None
+        if self.release_consumed_results:
+            # Tasks re-run here produce new results for their own consumers.
+            for name in plan:
+                self._held_results.pop(name, None)
+            consumers = {
+                name: set(names)
+                for name, names in dependents.items()
+                if plan[name].res_key_path is None
+            }
+
+        def schedule() -> None:
+            ready_names = tuple(ready)
+            ready.clear()
+            ready_tasks = self._calculate_ready_tasks(ready_names, plan)
+            for name, ready_task in zip(ready_names, ready_tasks):
+                running[name] = ready_task
+                ready_task.add_done_callback(
+                    lambda _, name=name: completion_queue.put_nowait(name)
+                )
 
-            ready_tasks = self._calculate_ready_tasks(
-                ready_names, task_func_map, task_deps_map, task_map
-            )
-
-            ready_task_results = await asyncio.gather(
-                *ready_tasks, return_exceptions=True
-            )
-
-            self._set_results(ready_names, ready_task_results, task_map)
+        try:
+            schedule()
+
+            while running:
+                # Handle every completion that is already queued before scheduling,
+                # so tasks released by the same batch are dispatched together.
+                finished = [await completion_queue.get()]
+                while not completion_queue.empty():
+                    finished.append(completion_queue.get_nowait())
+
+                for name in finished:
+                    try:
+                        result = running.pop(name).result()
+                    except BaseException as be:
+                        result = be
+
+                    self._set_results((name,), [result], task_map)
+
+                    # Dependents of a failed task are never released and are
+                    # recorded as failed below, so that they are re-run along with it.
+                    if isinstance(result, BaseException):
+                        continue
+
+                    for dependent in dependents[name]:
+                        remaining[dependent] -= 1
+                        if not remaining[dependent]:
+                            ready.append(dependent)
+
+                    if consumers is not None:
+                        self._release_consumed(name, plan[name].dep_names, consumers)
+
+                schedule()
+        finally:
+            # Only non-empty when arun is cancelled or the loop raises: don't
+            # leave orphaned tasks writing into task_results.
+            for running_task in running.values():
+                running_task.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+
+        for name, task in task_map.items():
+            if remaining[name]:
+                self.logger.error("Skipped task %s: a dependency failed", name)
+                self._failed_tasks[name] = task
 
-            ts.done(*ready_names)
+        # Results still needed to retry a failed or skipped consumer are kept.
+        if consumers is not None:
+            for name, outstanding in consumers.items():
+                if outstanding and name in self.task_results:
+                    self._held_results[name] = outstanding
 
-        elapsed_time = time() - start_time
-        elapsed_time_ms = elapsed_time * 1000
+        elapsed_ns = perf_counter_ns() - start_ns
         self.logger.info(
-            f"Executed tasks in {elapsed_time:.2f}s ({elapsed_time_ms:.0f}ms)"
+            "Executed tasks in %.2fs (%dms)", elapsed_ns / 1e9, elapsed_ns // 1_000_000
         )
 
-        return self.format_results(task_map)
+        return self.format_results(plan)
 
     def run(self, tasks_to_run: List[TPTask]) -> Dict[str, Any]:
         """Main entry point for executing tasks."""
@@ -274,7 +547,13 @@ class TopologicalTaskRunner:
         self._failed_tasks.clear()
         self.task_results.clear()
         self.task_errors.clear()
-        self.executor.shutdown(wait=False)
+        self._pure_cache.clear()
+        self._held_results.clear()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=False)
+            self._process_executor = None
 
 
 if __name__ == "__main__":